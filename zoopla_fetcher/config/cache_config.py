@@ -0,0 +1,9 @@
+import os
+
+# Root directory for anything cached on disk between runs
+CACHE_DIR = os.environ.get("ZOOPLA_FETCHER_CACHE_DIR",
+                           os.path.join(os.path.expanduser("~"), ".cache", "zoopla_fetcher"))
+OCR_CACHE_DIR = os.path.join(CACHE_DIR, "ocr")
+API_KEY_CACHE_DIR = os.path.join(CACHE_DIR, "api_key")
+# The graphql api key rarely changes, so it is only re-scraped once a day
+API_KEY_TTL_SECONDS = 24 * 60 * 60
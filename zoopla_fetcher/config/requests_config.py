@@ -1,4 +1,18 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 HEADERS = {
     'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36'
 }
 BASE_URL = 'https://www.zoopla.co.uk'
+POOL_SIZE = 64
+
+# Shared session, so connections to zoopla/zoocdn are kept alive and reused across all requests
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+_adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                       pool_maxsize=POOL_SIZE,
+                       max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 503)))
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
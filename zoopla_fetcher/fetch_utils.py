@@ -0,0 +1,70 @@
+"""
+Asynchronous fetching of raw html, used to fan out listing page requests
+"""
+import asyncio
+import aiohttp
+from zoopla_fetcher.config import requests_config
+from typing import List, Union
+import logging
+
+_logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 503)
+
+
+async def fetch_html(session: aiohttp.ClientSession,
+                     url: str,
+                     semaphore: asyncio.Semaphore,
+                     max_retries: int = 5,
+                     backoff_seconds: float = 0.5) -> Union[str, None]:
+    """
+    Fetch the raw html of one page, backing off exponentially when rate limited
+    :param session: Shared aiohttp session
+    :param url: Page url
+    :param semaphore: Semaphore bounding the number of requests in flight
+    :param max_retries: How many times a rate limited request is retried
+    :param backoff_seconds: Initial backoff, doubled on every retry
+    :return: Raw html of the page, None if it could not be fetched
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            async with semaphore:
+                async with session.get(url) as r:
+                    if r.status not in RETRY_STATUSES:
+                        r.raise_for_status()
+                        return await r.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError) as e:
+            _logger.error(f"Error fetching {url}: Exception {e!r}")
+            return None
+        if attempt < max_retries:
+            await asyncio.sleep(backoff_seconds * 2 ** attempt)
+    _logger.error(f"Error fetching {url}: still rate limited after {max_retries} retries")
+    return None
+
+
+def new_session(limit_per_host: int = 64) -> aiohttp.ClientSession:
+    """
+    :param limit_per_host: Max number of open connections per host
+    :return: aiohttp session with the default headers, to be shared across fetch_all_html calls
+    """
+    connector = aiohttp.TCPConnector(limit_per_host=limit_per_host)
+    return aiohttp.ClientSession(connector=connector, headers=requests_config.HEADERS)
+
+
+async def fetch_all_html(urls: List[str],
+                         concurrency: int = 128,
+                         limit_per_host: int = 64,
+                         session: aiohttp.ClientSession = None) -> List[Union[str, None]]:
+    """
+    Fetch the raw html of all pages concurrently
+    :param urls: Page urls
+    :param concurrency: Max number of requests in flight
+    :param limit_per_host: Max number of open connections per host, only used if no session is given
+    :param session: Session to fetch with, see new_session. A new one is opened and closed if not given
+    :return: Raw html per url, in the same order as the urls. None for pages that could not be fetched
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    if session is not None:
+        return await asyncio.gather(*(fetch_html(session, url, semaphore) for url in urls))
+    async with new_session(limit_per_host=limit_per_host) as session:
+        return await asyncio.gather(*(fetch_html(session, url, semaphore) for url in urls))
@@ -1,15 +1,54 @@
-import textract
-import os
-import tempfile
+import io
 import re
-import requests
-import numpy as np
+import math
+import hashlib
+import functools
+import diskcache
 from zoopla_fetcher.config import requests_config
-from typing import List, Union, Any
+from zoopla_fetcher.config import cache_config
+from typing import List, Union, Any, TYPE_CHECKING
 import logging
 
+if TYPE_CHECKING:
+    from PIL import Image
+
 _logger = logging.getLogger(__name__)
 
+_NUMBER_RE = re.compile(r"[\d]{1,}[\.\d]{0,}[\d]{0,}")
+# Captures the number in front of a square feet label, e.g. "1,234 sq ft", "850sq.ft" or "72 square feet"
+_SQ_FEET_RE = re.compile(r"([\d][\d,.]*)\s*(?:sq\.?\s*(?:ft|feet)|square\s*(?:ft|feet))")
+
+# Floorplans are a single block of text, and only the square footage is of interest
+_TESSERACT_CONFIG = "--psm 6 -c tessedit_char_whitelist=0123456789.,sqSQftFTeaurE"
+# Only small images are upscaled, by pixel size as the dpi metadata of web images is meaningless.
+# The upscale is capped, as tesseract's runtime and memory grow with the pixel count
+OCR_MIN_HEIGHT = 1000
+OCR_MAX_UPSCALE = 2.0
+_PREPROCESS_CONFIG = f"grayscale,min_height={OCR_MIN_HEIGHT},max_upscale={OCR_MAX_UPSCALE},smooth"
+
+
+@functools.lru_cache(maxsize=None)
+def _get_ocr_cache() -> diskcache.Cache:
+    """
+    OCR text keyed by image content hash, persisted across runs as many listings share the same floorplan.
+    Only opened on first use, so importing this module stays cheap
+    """
+    return diskcache.Cache(cache_config.OCR_CACHE_DIR)
+
+
+def _preprocess_image(image: "Image.Image") -> "Image.Image":
+    """
+    Prepare an image for OCR: grayscale, upscale small images towards OCR_MIN_HEIGHT, and smooth out noise
+    :param image: Raw image
+    :return: Preprocessed image
+    """
+    from PIL import Image, ImageFilter, ImageOps
+    image = ImageOps.grayscale(image)
+    if 0 < image.height < OCR_MIN_HEIGHT:
+        scale = min(OCR_MIN_HEIGHT / image.height, OCR_MAX_UPSCALE)
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+    return image.filter(ImageFilter.SMOOTH)
+
 
 def extract_text_from_image(img_url: str) -> str:
     """
@@ -17,17 +56,22 @@ def extract_text_from_image(img_url: str) -> str:
     :param img_url: Image url
     :return: Image text
     """
-    r = requests.get(img_url, headers=requests_config.HEADERS)
-    image_extension = img_url.split('.')[-1]
-    # Set up temporary file
-    tmp_f = tempfile.NamedTemporaryFile(suffix="." + image_extension, delete=False)
-    try:
-        tmp_f.write(r.content)
-        tmp_f.close()
-        text = textract.process(tmp_f.name, extension=image_extension, method="tesseract").decode("utf-8").lower()
+    # Stream the body straight into memory, and hand the connection back to the pool as soon as it is read
+    with requests_config.SESSION.get(img_url, stream=True) as r:
+        r.raise_for_status()
+        content = r.content
+    content_hash = hashlib.blake2b(content, digest_size=16).hexdigest()
+    cache_key = (content_hash, _TESSERACT_CONFIG, _PREPROCESS_CONFIG)
+    text = _get_ocr_cache().get(cache_key)
+    if text is not None:
         return text
-    finally:
-        os.remove(tmp_f.name)
+    # Imported here, as the OCR libraries are only needed once an image is actually parsed
+    import pytesseract
+    from PIL import Image
+    image = _preprocess_image(Image.open(io.BytesIO(content)))
+    text = pytesseract.image_to_string(image, config=_TESSERACT_CONFIG).lower()
+    _get_ocr_cache().set(cache_key, text)
+    return text
 
 
 def numbers_from_string(inp_str: str) -> List[float]:
@@ -36,15 +80,11 @@ def numbers_from_string(inp_str: str) -> List[float]:
     :param inp_str: Input string
     :return: All numbers
     """
-    pattern = "[\d]{1,}[\.\d]{0,}[\d]{0,}"
-    all_numbers = re.findall(pattern, inp_str.replace(",", ""))
-    float_numbers = []
-    for number in all_numbers:
-        if bool(re.search(r'\d', number)):
-            float_numbers.append(float(number))
-    return float_numbers
+    # Every match starts with a digit, so no further filtering is needed
+    return [float(number) for number in _NUMBER_RE.findall(inp_str.replace(",", ""))]
 
 
+@functools.lru_cache(maxsize=1024)
 def extract_total_sq_footage_from_floorplan(floorplan_url: str) -> Union[float, Any]:
     """
     Get the total square footage from a floorplan
@@ -52,12 +92,14 @@ def extract_total_sq_footage_from_floorplan(floorplan_url: str) -> Union[float,
     :return: Parsed out total square footage from the image
     """
     text = extract_text_from_image(floorplan_url)
-    sq_feet_pattern = "[0-9\.\,]{1,}[sq|\.|\s|square|s@|,]{1,}ft|[0-9\.\,]{1,}[sq|\.|\s|square|s@|,]{1,}feet"
-    matches = re.findall(sq_feet_pattern, text)
     all_sq_feet = []
-    for match in matches:
-        all_sq_feet.extend(numbers_from_string(match))
+    for match in _SQ_FEET_RE.findall(text):
+        try:
+            all_sq_feet.append(float(match.replace(",", "")))
+        except ValueError:
+            # OCR noise such as "1.234.5"
+            continue
     if all_sq_feet:
-        return np.nanmax(all_sq_feet)
+        return max(all_sq_feet)
     else:
-        return np.NaN
+        return math.nan
@@ -2,30 +2,152 @@
 Any details that require graphql can be done using this module
 """
 import re
+import orjson
 import requests
-from typing import Union
+import diskcache
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Union, List, Dict
 from zoopla_fetcher.config import requests_config
+from zoopla_fetcher.config import cache_config
+import logging
+
+_logger = logging.getLogger(__name__)
 
 
 API_URL = "https://api-graphql-lambda.prod.zoopla.co.uk/graphql"
 
+_JS_URL_RE = re.compile(r'script src="(https://r.zoocdn.com/_next/static/chunks/[^\s]*\.js)')
+_API_KEY_RE = re.compile(r'"X-Api-Key":"([\w]{1,})"')
+_API_KEY_CACHE_KEY = "graphql_api_key"
+# Statuses graph ql responds with when the api key is no longer valid
+API_KEY_REJECTED_STATUSES = (401, 403)
+
+# Building blocks of the ListingHistory query, also used to alias many listings into one batched query
+_LISTING_HISTORY_SELECTION = """{
+    ... on ListingData {
+      priceHistory {
+        ...History
+        __typename
+      }
+      viewCount {
+        ...ViewCount
+        __typename
+      }
+      __typename
+    }
+    ... on ListingResultError {
+      errorCode
+      __typename
+    }
+    __typename
+  }"""
+_LISTING_HISTORY_FRAGMENTS = """
+fragment History on PriceHistory {
+  firstPublished {
+    firstPublishedDate
+    priceLabel
+    __typename
+  }
+  lastSale {
+    date
+    newBuild
+    price
+    priceLabel
+    recentlySold
+    __typename
+  }
+  priceChanges {
+    isMinorChange
+    isPriceDrop
+    isPriceIncrease
+    percentageChangeLabel
+    priceChangeDate
+    priceChangeLabel
+    priceLabel
+    __typename
+  }
+  __typename
+}
+
+fragment ViewCount on ViewCount {
+  viewCount30day
+  __typename
+}
+"""
+_PRICE_HISTORY_QUERY = ("query ListingHistory($listingId: Int!) {\n"
+                        f"  listingDetails(id: $listingId) {_LISTING_HISTORY_SELECTION}\n"
+                        "}\n"
+                        f"{_LISTING_HISTORY_FRAGMENTS}")
+
+
+def _search_api_key(js_url: str) -> Union[str, None]:
+    """
+    :param js_url: URL of one of Zoopla's javascript chunks
+    :return: Graphql api key if the script includes it, else None
+    """
+    r = requests_config.SESSION.get(js_url)
+    api_key_hit = _API_KEY_RE.search(r.text)
+    return api_key_hit[1] if api_key_hit else None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_api_key_cache() -> diskcache.Cache:
+    """
+    :return: On disk cache of the api key, only opened on first use so importing this module stays cheap
+    """
+    return diskcache.Cache(cache_config.API_KEY_CACHE_DIR)
+
+
+def invalidate_cached_api_key():
+    """
+    Drop the api key cached on disk, e.g. once Zoopla has rotated it
+    """
+    _get_api_key_cache().delete(_API_KEY_CACHE_KEY)
+
+
+def is_api_key_rejected(error: Exception) -> bool:
+    """
+    :param error: Error raised by a graph ql query
+    :return: True if the query failed because the api key was rejected
+    """
+    return (isinstance(error, requests.HTTPError) and error.response is not None
+            and error.response.status_code in API_KEY_REJECTED_STATUSES)
+
 
-def extract_api_key(any_property_url: str) -> str:
+def extract_api_key(any_property_url: str, use_cache: bool = True) -> str:
     """
     :param any_property_url: URL of any property currently live on Zoopla
+    :param use_cache: If True, return the key cached on disk by a previous call, if it is less than a day old
     :return: Graphql api key
     """
-    raw_html = requests.get(any_property_url, headers=requests_config.HEADERS).text
+    if use_cache:
+        api_key = _get_api_key_cache().get(_API_KEY_CACHE_KEY)
+        if api_key is not None:
+            return api_key
+    raw_html = requests_config.SESSION.get(any_property_url).text
     # Extract all the javascript urls, as one of them includes the graphql api key
-    rgex = 'script src="https://r.zoocdn.com/_next/static/chunks/[^\s]*\.js'
-    js_script_urls = re.findall(rgex, raw_html)
-    for js_url in js_script_urls:
-        url = js_url.replace('script src="', '')
-        r = requests.get(url, headers=requests_config.HEADERS)
-        rgex = '"X-Api-Key":"([\w]{1,})"'
-        api_key_hits = re.findall(rgex, r.text)
-        if api_key_hits:
-            return api_key_hits[0]
+    js_script_urls = _JS_URL_RE.findall(raw_html)
+    # Search all scripts concurrently, and stop as soon as one of them has the key
+    executor = ThreadPoolExecutor(max_workers=8)
+    futures = {}
+    try:
+        futures = {executor.submit(_search_api_key, js_url): js_url for js_url in js_script_urls}
+        for future in as_completed(futures):
+            # A failure on one script should not stop the search, the key may be in another one
+            try:
+                api_key = future.result()
+            except Exception as e:
+                _logger.warning(f"Error searching {futures[future]} for the API key: Exception {e}")
+                continue
+            if api_key:
+                _get_api_key_cache().set(_API_KEY_CACHE_KEY, api_key, expire=cache_config.API_KEY_TTL_SECONDS)
+                return api_key
+    finally:
+        # Cancelled by hand rather than with shutdown(cancel_futures=True), which needs python 3.9
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
     raise Exception("No API key found")
 
 def extract_price_history_and_view_counts(listing_id: Union[int, str], api_key: str) -> dict:
@@ -35,17 +157,33 @@ def extract_price_history_and_view_counts(listing_id: Union[int, str], api_key:
     :param api_key: Zoopla's graphql API key
     :return: Query result
     """
-    payload = f'{{"operationName":"ListingHistory","variables":{{"listingId":{listing_id}}},"query":"query ListingHistory($listingId: Int\u0021) {{\\n  listingDetails(id: $listingId) {{\\n    ... on ListingData {{\\n      priceHistory {{\\n        ...History\\n        __typename\\n      }}\\n      viewCount {{\\n        ...ViewCount\\n        __typename\\n      }}\\n      __typename\\n    }}\\n    ... on ListingResultError {{\\n      errorCode\\n      __typename\\n    }}\\n    __typename\\n  }}\\n}}\\n\\nfragment History on PriceHistory {{\\n  firstPublished {{\\n    firstPublishedDate\\n    priceLabel\\n    __typename\\n  }}\\n  lastSale {{\\n    date\\n    newBuild\\n    price\\n    priceLabel\\n    recentlySold\\n    __typename\\n  }}\\n  priceChanges {{\\n    isMinorChange\\n    isPriceDrop\\n    isPriceIncrease\\n    percentageChangeLabel\\n    priceChangeDate\\n    priceChangeLabel\\n    priceLabel\\n    __typename\\n  }}\\n  __typename\\n}}\\n\\nfragment ViewCount on ViewCount {{\\n  viewCount30day\\n  __typename\\n}}\\n"}}'
-    headers = dict(requests_config.HEADERS)
-    headers["content-type"] = "application/json"
-    headers["x-api-key"] = api_key
-    raw_price_history_r = requests.post(url=API_URL,
-                                        data=payload,
-                                        headers=headers)
+    payload = {"operationName": "ListingHistory",
+               "variables": {"listingId": int(listing_id)},
+               "query": _PRICE_HISTORY_QUERY}
+    raw_price_history_r = requests_config.SESSION.post(url=API_URL,
+                                                       json=payload,
+                                                       headers={"x-api-key": api_key})
     raw_price_history_r.raise_for_status()
-    return raw_price_history_r.json()["data"]
-
-
-
+    return orjson.loads(raw_price_history_r.content)["data"]
 
 
+def extract_price_histories_batch(listing_ids: List[Union[int, str]], api_key: str) -> Dict[str, dict]:
+    """
+    Query graph ql for the price history and view counts of many listings in one request, by aliasing
+    one listingDetails field per listing
+    :param listing_ids: Ids of the zoopla listings
+    :param api_key: Zoopla's graphql API key
+    :return: Query result per listing id (as a string), in the same shape as extract_price_history_and_view_counts
+    """
+    variable_defs = ", ".join(f"$id{i}: Int!" for i in range(len(listing_ids)))
+    fields = "\n".join(f"  l{i}: listingDetails(id: $id{i}) {_LISTING_HISTORY_SELECTION}" for i in range(len(listing_ids)))
+    query = f"query ListingHistoryBatch({variable_defs}) {{\n{fields}\n}}\n{_LISTING_HISTORY_FRAGMENTS}"
+    payload = {"operationName": "ListingHistoryBatch",
+               "variables": {f"id{i}": int(listing_id) for i, listing_id in enumerate(listing_ids)},
+               "query": query}
+    raw_price_history_r = requests_config.SESSION.post(url=API_URL,
+                                                       json=payload,
+                                                       headers={"x-api-key": api_key})
+    raw_price_history_r.raise_for_status()
+    data = orjson.loads(raw_price_history_r.content)["data"]
+    return {str(listing_id): {"listingDetails": data[f"l{i}"]} for i, listing_id in enumerate(listing_ids)}
@@ -1,43 +1,79 @@
-import pandas as pd
-import requests
 import re
-import numpy as np
-import json
+import math
+import orjson
 from zoopla_fetcher.config import requests_config
 from zoopla_fetcher import floor_plan_utils
 from zoopla_fetcher import graphql_utils
-from typing import Union
+from typing import Union, Tuple, TYPE_CHECKING
 import logging
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 _logger = logging.getLogger(__name__)
 
+_PAGE_DATA_TAG = 'type="application/json">'
+_PAGE_DATA_START = _PAGE_DATA_TAG + '{"props":{"pageProps":'
+_PRICE_RE = re.compile(r"([\d]+(?:\.\d+)?)")
+
+
+def fetch_html(url: str) -> str:
+    """
+    :param url: url of the listing
+    :return: Raw html of the page
+    """
+    return requests_config.SESSION.get(url).text
+
+
+def parse_html(raw_html: str, url: str) -> dict:
+    """
+    Parse the listing details out of the raw html. Pure CPU work, so it can be run in a separate process
+    :param raw_html: Raw html of the listing
+    :param url: url of the listing, only used for the error message
+    :return: Raw dict of all listing details
+    """
+    try:
+        # Slice the page data json out between its script tag and the closing tag, no regex backtracking needed
+        start = raw_html.find(_PAGE_DATA_START)
+        if start < 0:
+            raise ValueError("Page data not found")
+        start += len(_PAGE_DATA_TAG)
+        end = raw_html.find("</script>", start)
+        raw_data = orjson.loads(raw_html[start:end])["props"]["pageProps"]
+        return raw_data["listingDetails"]
+    except Exception as e:
+        raise Exception(f"Could not extract raw data from url: {url}, error: {str(e)}")
+
+
+def parse_html_or_error(raw_html: Union[str, None], url: str) -> Tuple[Union[dict, None], Union[str, None]]:
+    """
+    Parse one listing's details. Meant to be run in a worker process, so the error is returned as a message
+    rather than logged
+    :param raw_html: Raw html of the listing, None if it could not be fetched
+    :param url: url of the listing
+    :return: Tuple of the parsed listing details (None if it failed) and the error message (None if it succeeded)
+    """
+    if raw_html is None:
+        return None, None
+    try:
+        return parse_html(raw_html, url), None
+    except Exception as e:
+        return None, str(e)
+
 
 class ListingDetails:
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, raw_html: str = None, listing_details: dict = None):
         """
         :param url: url of the listing
+        :param raw_html: Already fetched raw html of the listing. Fetched from the url if not given
+        :param listing_details: Already parsed listing details, see parse_html. Parsed from the raw html if not given
         """
         self._url = url
-        self._raw_html = self._extract_raw_html()
-        self._listing_details = self._extract_listing_details()
-
-    def _extract_raw_html(self) -> str:
-        """
-        :return: Raw html of the page
-        """
-        return requests.get(self._url, headers=requests_config.HEADERS).text
-
-    def _extract_listing_details(self) -> dict:
-        """
-        :return: Raw dict of all listing details
-        """
-        rgex = 'type="application\/json">({"props":{"pageProps":.*})<\/script>'
-        try:
-            raw_data = json.loads(re.search(rgex, self._raw_html)[1])["props"]["pageProps"]
-            return raw_data["listingDetails"]
-        except Exception as e:
-            raise Exception(f"Could not extract raw data from url: {self._url}, error: {str(e)}")
+        if listing_details is None:
+            raw_html = raw_html if raw_html is not None else fetch_html(url)
+            listing_details = parse_html(raw_html, url)
+        self._listing_details = listing_details
 
     @property
     def listing_id(self) -> int:
@@ -46,66 +82,83 @@ class ListingDetails:
         """
         return self._listing_details["listingId"]
 
-    def extract_main_details(self) -> pd.Series:
+    def extract_main_details(self) -> dict:
         """
         :return: Main details of the listing
         """
         main_details = self._listing_details["adTargeting"]
         filtered_details = {k: v for k, v in main_details.items() if "__" not in k}
-        return pd.Series(filtered_details)
+        return filtered_details
 
-    def extract_pois(self) -> pd.Series:
+    def extract_pois(self) -> dict:
         """
         :return: Any POIs associated with the property
         """
-        pois_df = pd.DataFrame(self._listing_details["pointsOfInterest"])
-        pois_closest = pois_df.sort_values("distanceMiles").groupby("type").first()
-        pois_closest_dict = pois_closest["title"].to_dict()
-        pois_closest.index = pois_closest.index + "_distance_miles"
-        pois_closest_dict.update(pois_closest["distanceMiles"].to_dict())
-        return pd.Series(pois_closest_dict).sort_index()
+        # Closest POI per type, found in one pass as there are only a handful of POIs
+        pois_closest = {}
+        for poi in self._listing_details["pointsOfInterest"]:
+            poi_type = poi["type"]
+            if poi_type not in pois_closest or poi["distanceMiles"] < pois_closest[poi_type]["distanceMiles"]:
+                pois_closest[poi_type] = poi
+        pois_closest_dict = {}
+        for poi_type, poi in pois_closest.items():
+            pois_closest_dict[poi_type] = poi["title"]
+            pois_closest_dict[poi_type + "_distance_miles"] = poi["distanceMiles"]
+        return dict(sorted(pois_closest_dict.items()))
 
-    def extract_detailed_description(self) -> pd.Series:
+    def extract_detailed_description(self) -> dict:
         """
         :return: Detailed description of the property
         """
-        return pd.Series({"detailedDescription": self._listing_details["detailedDescription"]})
+        return {"detailedDescription": self._listing_details["detailedDescription"]}
 
-    def extract_location(self) -> pd.Series:
+    def extract_location(self) -> dict:
         """
         :return: Lat/Long of the property
         """
         loc_details = self._listing_details["location"]["coordinates"]
-        return pd.Series({"latitude": loc_details["latitude"], "longitude": loc_details["longitude"]})
+        return {"latitude": loc_details["latitude"], "longitude": loc_details["longitude"]}
 
-    def extract_sq_footage(self) -> pd.Series:
+    def extract_sq_footage(self, first_match_only: bool = False) -> dict:
         """
+        :param first_match_only: If True, stop at the first floorplan a square footage is found in, as OCR is slow.
+                                 Else OCR all floorplans and return the largest square footage
         :return: Total square footage of the property
         """
         floor_plans = self._listing_details["floorPlan"]["image"]
         if floor_plans is None:
-            return pd.Series({"total_sq_footage": np.nan})
+            return {"total_sq_footage": math.nan}
         all_urls = ["https://lid.zoocdn.com/u/2400/1800/" + fp["filename"] for fp in floor_plans]
-        sq_footage = pd.Series(
-            [floor_plan_utils.extract_total_sq_footage_from_floorplan(url) for url in all_urls]).dropna().replace(0,
-                                                                                                                  np.nan)
-        if sq_footage.empty:
-            return pd.Series({"total_sq_footage": np.nan})
-        return pd.Series({"total_sq_footage": sq_footage.max()})
-
-    def extract_price_change_history(self, graphql_api_key: str, summarised: bool = True) -> Union[pd.Series, pd.DataFrame]:
+        total_sq_footage = math.nan
+        for url in all_urls:
+            sq_footage = floor_plan_utils.extract_total_sq_footage_from_floorplan(url)
+            if math.isnan(sq_footage) or sq_footage == 0:
+                continue
+            total_sq_footage = sq_footage if math.isnan(total_sq_footage) else max(total_sq_footage, sq_footage)
+            if first_match_only:
+                break
+        return {"total_sq_footage": total_sq_footage}
+
+    def extract_price_change_history(self,
+                                     graphql_api_key: str,
+                                     summarised: bool = True,
+                                     price_history: dict = None) -> Union[dict, "pd.DataFrame"]:
         """
+        :param graphql_api_key: Graph ql API key
         :param summarised: If True, returns a summarised version of the price change history
+        :param price_history: Already fetched graph ql price history result for this listing. Queried if not given
         :return: Price change history summary of the property if summarised=True, else
                  Detailed df of price change history
         """
-        price_history = graphql_utils.extract_price_history_and_view_counts(listing_id=self.listing_id,
-                                                                            api_key=graphql_api_key)
+        import pandas as pd
+        if price_history is None:
+            price_history = graphql_utils.extract_price_history_and_view_counts(listing_id=self.listing_id,
+                                                                                api_key=graphql_api_key)
         price_history = price_history["listingDetails"]["priceHistory"]
         first_listed = None
         data_records = []
         if price_history is None:
-            return pd.Series(dtype="object") if summarised else pd.DataFrame(dtype="object")
+            return {} if summarised else pd.DataFrame(dtype="object")
         # First published
         if price_history.get("firstPublished") is not None:
             record = price_history["firstPublished"]
@@ -129,10 +182,12 @@ class ListingDetails:
 
         out_df = pd.DataFrame(data_records)
         if out_df.empty:
-            return pd.Series(dtype="object") if summarised else pd.DataFrame(dtype="object")
+            return {} if summarised else pd.DataFrame(dtype="object")
 
         out_df["date"] = pd.to_datetime(out_df["date"])
-        out_df["price"] = out_df["price"].apply(lambda v: floor_plan_utils.numbers_from_string(v)[0])
+        out_df["price"] = (out_df["price"].str.replace(",", "", regex=False)
+                                          .str.extract(_PRICE_RE, expand=False)
+                                          .astype(float))
         out_df["listingId"] = self.listing_id
         out_df = out_df.set_index("date")
         out_df = out_df.sort_index()
@@ -143,36 +198,57 @@ class ListingDetails:
             avg_pct_change = listing_changes.mean()
             max_pct_change = listing_changes.max()
             min_pct_change = listing_changes.min()
-            return pd.Series({"first_listed": first_listed,
-                              "number_of_price_changes": number_of_changes,
-                              "avg_pct_per_price_change": avg_pct_change,
-                              "max_pct_per_price_change": max_pct_change,
-                              "min_pct_per_price_change": min_pct_change})
+            return {"first_listed": first_listed,
+                    "number_of_price_changes": number_of_changes,
+                    "avg_pct_per_price_change": avg_pct_change,
+                    "max_pct_per_price_change": max_pct_change,
+                    "min_pct_per_price_change": min_pct_change}
         else:
             return out_df
 
-    def extract_all(self, graphql_api_key: str) -> pd.Series:
+    def extract_all_dict(self,
+                         graphql_api_key: str,
+                         price_history: dict = None,
+                         sq_footage_first_match_only: bool = False) -> dict:
         """
         :param graphql_api_key: Graph ql API key
-        :return: All details in a series
+        :param price_history: Already fetched graph ql price history result for this listing. Queried if not given
+        :param sq_footage_first_match_only: See extract_sq_footage's first_match_only
+        :return: All details in a dict
         """
-        property_data = []
+        property_data = {}
         all_methods = [
             self.extract_main_details,
             self.extract_pois,
             self.extract_detailed_description,
             self.extract_location,
-            self.extract_sq_footage,
         ]
         for method in all_methods:
-            property_data.append(method())
+            property_data.update(method())
+        property_data.update(self.extract_sq_footage(first_match_only=sq_footage_first_match_only))
 
         # Price History
-        property_data.append(self.extract_price_change_history(graphql_api_key=graphql_api_key,
-                                                               summarised=True))
-        property_data_series = pd.concat(property_data)
-        property_data_series.index.name = self.listing_id
+        property_data.update(self.extract_price_change_history(graphql_api_key=graphql_api_key,
+                                                               summarised=True,
+                                                               price_history=price_history))
 
-        if pd.notnull(property_data_series["total_sq_footage"]):
-            property_data_series["pounds_per_sq_foot"] = property_data_series["price"] / property_data_series["total_sq_footage"]
+        if not math.isnan(property_data["total_sq_footage"]):
+            property_data["pounds_per_sq_foot"] = property_data["price"] / property_data["total_sq_footage"]
+        return property_data
+
+    def extract_all(self,
+                    graphql_api_key: str,
+                    price_history: dict = None,
+                    sq_footage_first_match_only: bool = False) -> "pd.Series":
+        """
+        :param graphql_api_key: Graph ql API key
+        :param price_history: Already fetched graph ql price history result for this listing. Queried if not given
+        :param sq_footage_first_match_only: See extract_sq_footage's first_match_only
+        :return: All details in a series
+        """
+        import pandas as pd
+        property_data_series = pd.Series(self.extract_all_dict(graphql_api_key=graphql_api_key,
+                                                               price_history=price_history,
+                                                               sq_footage_first_match_only=sq_footage_first_match_only))
+        property_data_series.index.name = self.listing_id
         return property_data_series
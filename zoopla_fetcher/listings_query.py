@@ -1,24 +1,93 @@
-import pandas as pd
-
+import asyncio
+from zoopla_fetcher import listing_details
 from zoopla_fetcher.listing_details import ListingDetails
 from zoopla_fetcher import graphql_utils
 from tqdm import tqdm
-from bs4 import BeautifulSoup
-import requests
 import re
 from zoopla_fetcher.config import requests_config
 import logging
+import threading
 from multiprocessing.pool import ThreadPool
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Union, Tuple, Callable, TYPE_CHECKING
+
+try:
+    # selectolax >= 1.0 only ships the lexbor backend, older releases only the modest one
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser
+    except ImportError:
+        HTMLParser = None
+        from bs4 import BeautifulSoup
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 _logger = logging.getLogger(__name__)
 
+_SEARCH_IDENTIFIER_RE = re.compile(r'\?search_identifier=.{1,}')
+_TOTAL_RESULTS_RE = re.compile(r'([\d]{1,})')
+_LISTING_ID_RE = re.compile(r'/details/([\d]{1,})')
+
+
+def _parse_listing_hrefs(html: str) -> List[str]:
+    """
+    Parse out the href of every listing link in a results page
+    :param html: Raw html of the results page
+    :return: All listing hrefs
+    """
+    if HTMLParser is not None:
+        return [a.attributes["href"] for a in HTMLParser(html).css('a[data-testid="listing-details-link"]')]
+    souped = BeautifulSoup(html, 'html.parser')
+    return [a['href'] for a in souped.findAll('a', {'data-testid': 'listing-details-link'})]
+
+
+def _parse_listing_urls(html: str) -> List[str]:
+    """
+    :param html: Raw html of the results page
+    :return: Full url of every listing in the results page
+    """
+    return [requests_config.BASE_URL + _SEARCH_IDENTIFIER_RE.sub('', href) for href in _parse_listing_hrefs(html)]
+
+
+def _parse_total_results_text(html: str) -> Union[str, None]:
+    """
+    Parse out the total results text of a results page
+    :param html: Raw html of the results page
+    :return: Total results text, None if it is not on the page
+    """
+    if HTMLParser is not None:
+        node = HTMLParser(html).css_first('p[data-testid="total-results"]')
+        return node.text() if node is not None else None
+    souped = BeautifulSoup(html, 'html.parser')
+    total_results_element = souped.findAll('p', {'data-testid': 'total-results'})
+    return total_results_element[0].text if total_results_element else None
+
+
+def _fetch_listing_html(listing_url: str) -> Union[str, None]:
+    """
+    :param listing_url: Listing url
+    :return: Raw html of the listing, None if it could not be fetched
+    """
+    try:
+        return listing_details.fetch_html(listing_url)
+    except Exception as e:
+        _logger.error(f"Error fetching property {listing_url}: Exception {e}")
+        return None
+
 
 class ListingsQuery:
     """
     Manage the full data fetch for a query
     """
     MAX_RESULTS = 10000
+    # Results pages are fetched concurrently, capped to stay within Zoopla's rate limits
+    PAGE_FETCH_THREADS = 16
+    # Listings are fetched and parsed in chunks, so only one chunk of raw html is held in memory at a time
+    LISTINGS_CHUNK_SIZE = 256
+    PARSE_CHUNK_SIZE = 16
+    PRICE_HISTORY_BATCH_SIZE = 25
 
     def __init__(self,
                  query_string: str,
@@ -34,7 +103,9 @@ class ListingsQuery:
                  include_auctions: bool = True,
                  include_sold: bool = False,
                  retirement_homes: bool = True,
-                 include_shared_accommodation: bool = False):
+                 include_shared_accommodation: bool = False,
+                 use_cache: bool = True,
+                 sq_footage_first_match_only: bool = False):
         """
         :param query_string: The location name (postcode of a city name)
         :param query_type: Either for-sale or to-rent
@@ -50,6 +121,10 @@ class ListingsQuery:
         :param include_sold: Whether already sold properties should be returned
         :param retirement_homes: Whether retirement should be returned
         :param include_shared_accommodation: Whether sjared accommodation results should be returned
+        :param use_cache: Whether the graph ql API key cached by a previous run can be reused
+        :param sq_footage_first_match_only: If True, stop OCRing a listing's floorplans at the first one a square
+                                            footage is found in, rather than taking the max over all of them. Faster,
+                                            but the first floorplan is often a single floor
         """
 
         if query_type not in ["for-sale", "to-rent"]:
@@ -72,9 +147,13 @@ class ListingsQuery:
         self.include_sold = include_sold
         self.retirement_homes = retirement_homes
         self.include_shared_accommodation = include_shared_accommodation
+        self.sq_footage_first_match_only = sq_footage_first_match_only
         self._query_url = self._gen_query_url()
         self.listing_urls = self.get_all_listing_urls()
-        self.graphql_api_key = self.get_graphql_api_key()
+        self.graphql_api_key = self.get_graphql_api_key(use_cache=use_cache)
+        self._api_key_lock = threading.Lock()
+        self._api_key_refreshed = False
+        self._price_history_by_id = {}
 
     def gen_query_params(self) -> dict:
         """
@@ -112,8 +191,8 @@ class ListingsQuery:
         loop through to get all property urls
         """
         query_params = self.gen_query_params()
-        r = requests.get(requests_config.BASE_URL + "/search/", params=query_params, headers=requests_config.HEADERS,
-                         allow_redirects=False)
+        r = requests_config.SESSION.get(requests_config.BASE_URL + "/search/", params=query_params,
+                                        allow_redirects=False)
         new_endpoint = r.headers["location"]
         additional_params = [
             "page_size=100",
@@ -128,11 +207,8 @@ class ListingsQuery:
         :return: List of all listing urls in the page
         """
         new_url = self._query_url.replace("pn=1", "pn=" + str(page_number))
-        r = requests.get(new_url, headers=requests_config.HEADERS)
-        souped = BeautifulSoup(r.text, 'html.parser')
-        prop_url_tags = souped.findAll('a', {'data-testid': 'listing-details-link'})
-        prop_urls = [requests_config.BASE_URL + re.sub('\?search_identifier=.{1,}', '', a['href']) for a in prop_url_tags]
-        return prop_urls
+        r = requests_config.SESSION.get(new_url)
+        return _parse_listing_urls(r.text)
 
     def get_all_listing_urls(self) -> List[str]:
         """
@@ -140,11 +216,10 @@ class ListingsQuery:
         :return: List of all listing urls for the query
         """
         _logger.info("Getting all listing urls for given query...")
-        first_request = requests.get(self._query_url, headers=requests_config.HEADERS)
-        souped = BeautifulSoup(first_request.text, 'html.parser')
-        total_results_element = souped.findAll('p', {'data-testid': 'total-results'})
-        if len(total_results_element) > 0:
-            total_results_str = re.search('([\d]{1,})', total_results_element[0].text).group(1)
+        first_request = requests_config.SESSION.get(self._query_url)
+        total_results_text = _parse_total_results_text(first_request.text)
+        if total_results_text is not None:
+            total_results_str = _TOTAL_RESULTS_RE.search(total_results_text).group(1)
             total_results = int(total_results_str)
         else:
             raise Exception("Could not get page data")
@@ -154,22 +229,97 @@ class ListingsQuery:
 
         pages_divmod = divmod(total_results, 100)
         total_pages = pages_divmod[0] + 1 if pages_divmod[1] > 0 else pages_divmod[0]
-        listing_urls = []
-        for page_number in tqdm(range(1, total_pages + 1)):
-            listing_urls.extend(self._get_page_property_urls(page_number))
+        # The first page has already been fetched, the rest do not depend on each other so are fetched concurrently
+        listing_urls = _parse_listing_urls(first_request.text)
+        with ThreadPoolExecutor(max_workers=self.PAGE_FETCH_THREADS) as executor:
+            for page_urls in tqdm(executor.map(self._get_page_property_urls, range(2, total_pages + 1)),
+                                  total=max(total_pages - 1, 0)):
+                listing_urls.extend(page_urls)
 
         return listing_urls
 
-    def get_graphql_api_key(self) -> str:
+    def get_graphql_api_key(self, use_cache: bool = True) -> str:
         """
         Get GraphQl API key, used for price history data
+        :param use_cache: If True, reuse the key cached by a previous run if it is still fresh
         :return: GraphQl API key
         """
         _logger.info("Extracting graph ql API key for price history queries...")
-        api_key = graphql_utils.extract_api_key(any_property_url=self.listing_urls[0])
+        api_key = graphql_utils.extract_api_key(any_property_url=self.listing_urls[0], use_cache=use_cache)
         _logger.info(f"API key found: {api_key}")
         return api_key
 
+    def _refresh_graphql_api_key(self, rejected_api_key: str) -> bool:
+        """
+        Re-scrape the GraphQl API key once it has been rejected, e.g. because Zoopla rotated it. Only done once per
+        query, and only by the first thread that sees the rejection
+        :param rejected_api_key: API key that was rejected
+        :return: True if there is a new API key to retry with
+        """
+        with self._api_key_lock:
+            if self.graphql_api_key == rejected_api_key and not self._api_key_refreshed:
+                self._api_key_refreshed = True
+                _logger.warning("GraphQl API key was rejected, extracting a new one...")
+                graphql_utils.invalidate_cached_api_key()
+                self.graphql_api_key = self.get_graphql_api_key(use_cache=False)
+            return self.graphql_api_key != rejected_api_key
+
+    def _query_graphql(self, query: Callable, **kwargs):
+        """
+        Run a graph ql query with the current API key, retrying once with a new key if it is rejected
+        :param query: One of the graphql_utils query functions, taking an api_key argument
+        :param kwargs: Other arguments of the query
+        :return: Query result
+        """
+        api_key = self.graphql_api_key
+        try:
+            return query(api_key=api_key, **kwargs)
+        except Exception as e:
+            if not graphql_utils.is_api_key_rejected(e) or not self._refresh_graphql_api_key(api_key):
+                raise
+        return query(api_key=self.graphql_api_key, **kwargs)
+
+    def _get_price_history(self, listing_id: Union[int, str]) -> dict:
+        """
+        :param listing_id: Listing id
+        :return: Prefetched price history of the listing, queried if it was not prefetched
+        """
+        price_history = self._price_history_by_id.get(str(listing_id))
+        if price_history is None:
+            price_history = self._query_graphql(graphql_utils.extract_price_history_and_view_counts,
+                                                listing_id=listing_id)
+        return price_history
+
+    def _get_price_history_batch(self, listing_ids: List[str]) -> dict:
+        """
+        Query the price history for one batch of listings
+        :param listing_ids: Listing ids in the batch
+        :return: Price history per listing id, empty if the query failed
+        """
+        try:
+            return self._query_graphql(graphql_utils.extract_price_histories_batch, listing_ids=listing_ids)
+        except Exception as e:
+            _logger.error(f"Error extracting batched price history, falling back to per listing queries: Exception {e}")
+            return {}
+
+    def prefetch_price_histories(self, threads: int = 10):
+        """
+        Query the price history of all listings in batches of PRICE_HISTORY_BATCH_SIZE, so the per listing
+        extraction does not need to query graph ql one listing at a time
+        :param threads: How many threads should be used for the parallel process
+        """
+        listing_ids = []
+        for listing_url in self.listing_urls:
+            listing_id_match = _LISTING_ID_RE.search(listing_url)
+            if listing_id_match and listing_id_match.group(1) not in self._price_history_by_id:
+                listing_ids.append(listing_id_match.group(1))
+        batches = [listing_ids[i:i + self.PRICE_HISTORY_BATCH_SIZE]
+                   for i in range(0, len(listing_ids), self.PRICE_HISTORY_BATCH_SIZE)]
+        _logger.info("Prefetching price history for all listings...")
+        with ThreadPool(threads) as pool:
+            for batch_result in pool.imap_unordered(self._get_price_history_batch, batches):
+                self._price_history_by_id.update(batch_result)
+
     @property
     def total_listings(self) -> int:
         """
@@ -177,42 +327,167 @@ class ListingsQuery:
         """
         return len(self.listing_urls)
 
-    def get_listing_details(self, listing_url: str) -> pd.Series:
+    def _get_listing_details_dict(self, listing_url: str, raw_html: str = None, parsed_details: dict = None) -> dict:
         """
-        Extract details for 1 property listing
+        Extract details for 1 property listing as a plain dict, so many listings can be put in one DataFrame at once
         :param listing_url: Listing url
-        :return: All details for the listing
+        :param raw_html: Already fetched raw html of the listing, if available
+        :param parsed_details: Already parsed listing details, if available
+        :return: All details for the listing, empty if they could not be extracted
         """
         try:
-            p = ListingDetails(listing_url)
-            return p.extract_all(graphql_api_key=self.graphql_api_key)
+            p = ListingDetails(listing_url, raw_html=raw_html, listing_details=parsed_details)
+            return p.extract_all_dict(graphql_api_key=self.graphql_api_key,
+                                      price_history=self._get_price_history(p.listing_id),
+                                      sq_footage_first_match_only=self.sq_footage_first_match_only)
         except Exception as e:
             _logger.error(f"Error extracting property details {listing_url}: Exception {e}")
-            return pd.Series(dtype="object")
+            return {}
+
+    def get_listing_details(self, listing_url: str, raw_html: str = None, parsed_details: dict = None) -> "pd.Series":
+        """
+        Extract details for 1 property listing
+        :param listing_url: Listing url
+        :param raw_html: Already fetched raw html of the listing, if available
+        :param parsed_details: Already parsed listing details, if available
+        :return: All details for the listing
+        """
+        import pandas as pd
+        return pd.Series(self._get_listing_details_dict(listing_url, raw_html=raw_html, parsed_details=parsed_details),
+                         dtype="object")
+
+    def _get_parsed_listing_details(self, url_and_details: Tuple[str, dict]) -> dict:
+        """
+        :param url_and_details: Listing url and its already parsed listing details
+        :return: All details for the listing
+        """
+        listing_url, parsed_details = url_and_details
+        return self._get_listing_details_dict(listing_url, parsed_details=parsed_details)
 
-    def get_listing_price_history(self, listing_url) -> pd.DataFrame:
+    def get_listing_price_history(self, listing_url) -> "pd.DataFrame":
         """
         Extract a more detailed breakdown of price change history for the listing
         :param listing_url: Listing url
         :return: Detailed price history
         """
+        import pandas as pd
         try:
             p = ListingDetails(listing_url)
             return p.extract_price_change_history(summarised=False,
-                                                  graphql_api_key=self.graphql_api_key)
+                                                  graphql_api_key=self.graphql_api_key,
+                                                  price_history=self._get_price_history(p.listing_id))
         except Exception as e:
             _logger.error(f"Error extracting property price history {listing_url}: Exception {e}")
             return pd.DataFrame()
 
-    def extract_all_properties_details(self, threads: int = 10) -> pd.DataFrame:
+    def _parse_all_listing_html(self,
+                                executor: ProcessPoolExecutor,
+                                listing_urls: List[str],
+                                raw_htmls: List[Union[str, None]]) -> List[Union[dict, None]]:
+        """
+        Parse the listing details out of the raw htmls on a process pool, as the parsing is CPU bound
+        :param executor: Process pool to parse on
+        :param listing_urls: Listing urls
+        :param raw_htmls: Raw html per listing url, None if it could not be fetched
+        :return: Parsed listing details per listing url, None if it could not be fetched or parsed
+        """
+        all_parsed = []
+        parsed_results = executor.map(listing_details.parse_html_or_error, raw_htmls, listing_urls, chunksize=self.PARSE_CHUNK_SIZE)
+        for listing_url, (parsed, error) in zip(listing_urls, parsed_results):
+            if error is not None:
+                _logger.error(f"Error extracting property details {listing_url}: Exception {error}")
+            all_parsed.append(parsed)
+        return all_parsed
+
+    def extract_all_properties_details(self, threads: int = 10, processes: int = None) -> "pd.DataFrame":
         """
         Loop over all listing urls in parallel, and generate the full results
         :param threads: How many threads should be used for the parallel process
+        :param processes: If given, listing pages are fetched on the thread pool in chunks, parsed on a process pool
+                          of this many processes, and then the floorplan and price history lookups run on the thread
+                          pool. Only worth it if parsing is the bottleneck. If None, every listing is fetched, parsed
+                          and extracted in one go on the thread pool
         :return: Full result of the query
         """
-        with ThreadPool(threads) as pool:
-            all_results = list(tqdm(pool.imap(self.get_listing_details, self.listing_urls), total=self.total_listings))
-        return pd.DataFrame(all_results).set_index("listingId")
+        import pandas as pd
+        self.prefetch_price_histories(threads=threads)
+        if processes is None:
+            with ThreadPool(threads) as pool:
+                all_results = list(tqdm(pool.imap(self._get_listing_details_dict, self.listing_urls),
+                                        total=self.total_listings))
+            return pd.DataFrame.from_records(all_results).set_index("listingId")
+
+        all_results = []
+        with ProcessPoolExecutor(max_workers=processes) as executor, ThreadPool(threads) as pool, \
+                tqdm(total=self.total_listings) as progress:
+            for i in range(0, self.total_listings, self.LISTINGS_CHUNK_SIZE):
+                listing_urls = self.listing_urls[i:i + self.LISTINGS_CHUNK_SIZE]
+                raw_htmls = pool.map(_fetch_listing_html, listing_urls)
+                all_parsed = self._parse_all_listing_html(executor, listing_urls, raw_htmls)
+                to_extract = [(url, parsed) for url, parsed in zip(listing_urls, all_parsed) if parsed is not None]
+                for result in pool.imap(self._get_parsed_listing_details, to_extract):
+                    all_results.append(result)
+                    progress.update()
+                progress.update(len(listing_urls) - len(to_extract))
+        return pd.DataFrame.from_records(all_results).set_index("listingId")
+
+    async def extract_all_properties_details_async(self,
+                                                   threads: int = 10,
+                                                   concurrency: int = 128,
+                                                   processes: int = None) -> "pd.DataFrame":
+        """
+        Fetch all listing pages concurrently with aiohttp, then generate the full results from the fetched html.
+        The floorplan and price history lookups are run on a thread pool
+        :param threads: How many threads should be used to process the fetched listings
+        :param concurrency: Max number of listing page requests in flight
+        :param processes: If given, the html is parsed on a process pool of this many processes. If None, it is
+                          parsed on the thread pool
+        :return: Full result of the query
+        """
+        # Imported here, so aiohttp is only loaded when the async path is used
+        import pandas as pd
+        from zoopla_fetcher import fetch_utils
+        loop = asyncio.get_running_loop()
+        prefetch = loop.run_in_executor(None, self.prefetch_price_histories, threads)
+        # Fetch in chunks so only a couple of chunks of raw html are held in memory at a time
+        chunks = [self.listing_urls[i:i + self.LISTINGS_CHUNK_SIZE]
+                  for i in range(0, self.total_listings, self.LISTINGS_CHUNK_SIZE)]
+        all_results = []
+        process_executor = ProcessPoolExecutor(max_workers=processes) if processes is not None else None
+        try:
+            async with fetch_utils.new_session() as session:
+                with ThreadPoolExecutor(threads) as executor, tqdm(total=self.total_listings) as progress:
+                    next_fetch = None
+                    if chunks:
+                        next_fetch = asyncio.ensure_future(
+                            fetch_utils.fetch_all_html(chunks[0], concurrency=concurrency, session=session))
+                    await prefetch
+                    for chunk_number, listing_urls in enumerate(chunks):
+                        raw_htmls = await next_fetch
+                        # Start fetching the next chunk while this one is processed
+                        if chunk_number + 1 < len(chunks):
+                            next_fetch = asyncio.ensure_future(
+                                fetch_utils.fetch_all_html(chunks[chunk_number + 1], concurrency=concurrency,
+                                                           session=session))
+                        if process_executor is None:
+                            to_extract = [(url, raw_html, None) for url, raw_html in zip(listing_urls, raw_htmls)
+                                          if raw_html is not None]
+                        else:
+                            all_parsed = await loop.run_in_executor(None, self._parse_all_listing_html,
+                                                                    process_executor, listing_urls, raw_htmls)
+                            to_extract = [(url, None, parsed) for url, parsed in zip(listing_urls, all_parsed)
+                                          if parsed is not None]
+                        del raw_htmls
+                        futures = [loop.run_in_executor(executor, self._get_listing_details_dict, *args)
+                                   for args in to_extract]
+                        for f in asyncio.as_completed(futures):
+                            all_results.append(await f)
+                            progress.update()
+                        progress.update(len(listing_urls) - len(to_extract))
+        finally:
+            if process_executor is not None:
+                process_executor.shutdown()
+        return pd.DataFrame.from_records(all_results).set_index("listingId")
 
     def extract_all_properties_price_history(self, threads: int = 10):
         """
@@ -220,6 +495,8 @@ class ListingsQuery:
         :param threads: How many threads should be used for the parallel process
         :return: Price history of all properties
         """
+        import pandas as pd
+        self.prefetch_price_histories(threads=threads)
         with ThreadPool(threads) as pool:
             all_results = list(
                 tqdm(pool.imap(self.get_listing_price_history, self.listing_urls), total=self.total_listings))